@@ -3,6 +3,10 @@ Initialize the tagger if needed and process input files by calling the specific
 and ensuring the output is written to the expected file.
 """
 
+# Standard library
+import os
+import tempfile
+
 # The extension of output files produced by the tagger.
 OUTPUT_EXTENSION = ".tsv"
 
@@ -26,3 +30,19 @@ def process(in_file: str, out_file: str) -> None:
     f_out = open(out_file, "x")
     f_out.write("Did you forget to override process.py?")
     f_out.close()
+
+
+def process_text(text: str) -> str:
+    """
+    Process a short text and return the result, for /tag.
+    By default the text is processed by process() through temporary files.
+    Override this if the tagger can process text in memory.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        in_file = os.path.join(temp_dir, "in.txt")
+        out_file = os.path.join(temp_dir, "out" + OUTPUT_EXTENSION)
+        with open(in_file, "w", encoding="utf-8") as f:
+            f.write(text)
+        process(in_file, out_file)
+        with open(out_file, encoding="utf-8") as f:
+            return f.read()
@@ -0,0 +1,182 @@
+"""
+Retention of the output, error and status folders.
+
+Outputs the callback server wants to KEEP, inputs moved to the error folder, and statusses of files
+without a callback server are never deleted by the tagger worker itself. A background thread in the
+tagger worker deletes files from these folders once they are older than a time to live,
+and deletes the oldest files when a folder exceeds its size budget.
+Either limit is disabled by setting it to 0.
+
+The result of the last run is stored in a json file for the /admin/disk endpoint of the webservice.
+"""
+
+# Standard library
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable
+
+# Local
+from shared import OUTPUT_FOLDER, ERROR_FOLDER, RETENTION_FILE
+from shared import scan_sharded, shard_folder, try_stat
+from statuslogger import StatusLogger, STATUS_FOLDER
+
+# Seconds between runs.
+GC_INTERVAL: float = float(os.getenv("GC_INTERVAL") or 3600)
+# Files younger than this many seconds are never deleted, as they might still be in use.
+MIN_AGE = 60
+
+DAY = 24 * 60 * 60
+GB = 1024**3
+
+
+class RetentionPolicy:
+    """
+    Time to live (seconds) and size budget (bytes) of a sharded folder.
+    The can_delete check receives a file name and protects files that are still needed.
+    """
+
+    def __init__(
+        self,
+        folder: str,
+        ttl: float,
+        max_bytes: int,
+        can_delete: Callable[[str], bool] = lambda filename: True,
+    ) -> None:
+        self.folder = folder
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.can_delete = can_delete
+
+    def collect(self) -> dict[str, Any]:
+        """
+        Delete expired files, then the oldest files until the folder fits its budget.
+        """
+        now = time.time()
+        deleted_files = 0
+        deleted_bytes = 0
+
+        # Oldest first
+        entries = []
+        for entry in scan_sharded(self.folder):
+            stat = try_stat(entry)
+            if stat is not None:
+                entries.append((stat.st_mtime, stat.st_size, entry))
+        entries.sort(key=lambda e: e[0])
+        total_bytes = sum(size for _, size, _ in entries)
+
+        remaining = []
+        for mtime, size, entry in entries:
+            age = now - mtime
+            over_ttl = self.ttl > 0 and age > self.ttl
+            over_budget = self.max_bytes > 0 and total_bytes > self.max_bytes
+            if (
+                (over_ttl or over_budget)
+                and age > MIN_AGE
+                and self.can_delete(entry.name)
+                and self._delete(entry.path)
+            ):
+                deleted_files += 1
+                deleted_bytes += size
+                total_bytes -= size
+            else:
+                remaining.append(entry)
+
+        return {
+            "files": len(remaining),
+            "bytes": total_bytes,
+            "deletedFiles": deleted_files,
+            "deletedBytes": deleted_bytes,
+            "ttl": self.ttl,  # seconds
+            "maxBytes": self.max_bytes,
+        }
+
+    @staticmethod
+    def _delete(path: str) -> bool:
+        # "try", because the file might have been deleted through the webservice in the meantime.
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+
+def is_done(filename: str) -> bool:
+    """
+    Only the statusses of finished or failed files can be deleted. Pending and busy files still need them.
+    """
+    status = StatusLogger(filename).get_status()
+    return not (status["pending"] or status["busy"])
+
+
+POLICIES = [
+    RetentionPolicy(
+        OUTPUT_FOLDER,
+        ttl=float(os.getenv("OUTPUT_TTL") or 7 * DAY),
+        max_bytes=int(os.getenv("OUTPUT_MAX_BYTES") or 10 * GB),
+    ),
+    RetentionPolicy(
+        ERROR_FOLDER,
+        ttl=float(os.getenv("ERROR_TTL") or 7 * DAY),
+        max_bytes=int(os.getenv("ERROR_MAX_BYTES") or 1 * GB),
+    ),
+    RetentionPolicy(
+        STATUS_FOLDER,
+        ttl=float(os.getenv("STATUS_TTL") or 7 * DAY),
+        max_bytes=int(os.getenv("STATUS_MAX_BYTES") or GB // 10),
+        can_delete=is_done,
+    ),
+]
+
+
+def get_usage(folder: str) -> dict[str, int]:
+    """
+    Number of files and their total size in a (sharded) folder.
+    """
+    stats = [try_stat(entry) for entry in scan_sharded(folder)]
+    sizes = [stat.st_size for stat in stats if stat is not None]
+    return {"files": len(sizes), "bytes": sum(sizes)}
+
+
+def collect_all() -> None:
+    """
+    Apply all policies and store the result.
+    """
+    start = time.time()
+    folders = {}
+    for policy in POLICIES:
+        folders[policy.folder] = policy.collect()
+        if folders[policy.folder]["deletedFiles"] > 0:
+            logging.info(
+                f"Retention deleted {folders[policy.folder]['deletedFiles']} files from {policy.folder}"
+            )
+    result = {
+        "time": start,
+        "duration": round(time.time() - start, 3),  # seconds
+        "folders": folders,
+    }
+    tmp_path = RETENTION_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(result, f)
+    os.replace(tmp_path, RETENTION_FILE)
+
+
+def run() -> None:
+    while True:
+        try:
+            collect_all()
+        except Exception as e:
+            # Try again next interval.
+            logging.error(f"Retention failed: {e}")
+        time.sleep(GC_INTERVAL)
+
+
+def start() -> None:
+    """
+    Move files of the old flat layout to their shards, and start the retention thread.
+    """
+    for policy in POLICIES:
+        shard_folder(policy.folder)
+    threading.Thread(target=run, daemon=True).start()
@@ -1,11 +1,23 @@
 # Contains values used by both tagger worker and webservice
 
 import os
+from typing import Iterator, Optional
 
 UPLOAD_FOLDER = "input"
 OUTPUT_FOLDER = "output"
 ERROR_FOLDER = "error"
 
+# Written by the supervisor in the tagger worker, read by the webservice for /health.
+SUPERVISOR_FILE = "supervisor.json"
+# Written by the retention thread in the tagger worker, read by the webservice for /admin/disk.
+RETENTION_FILE = "retention.json"
+# Unix socket on which the supervisor in the tagger worker answers /tag requests of the webservice.
+TAG_SOCKET = "tagger.sock"
+
+# The output, error and status folders are sharded on the first characters of the file name,
+# so that no single directory grows too large to list. Identifiers are uuids, so this gives 256 shards.
+SHARD_WIDTH = 2
+
 TEXT_EXTENSIONS = {"txt"}
 ALLOWED_EXTENSIONS = TEXT_EXTENSIONS
 
@@ -14,6 +26,60 @@ def file_extension(filename):
     return filename.rsplit(".", 1)[1].lower()
 
 
+def shard_path(folder: str, filename: str, create: bool = False) -> str:
+    """
+    Path of a file in a sharded folder, e.g. output/3f/3f2a...tsv.
+    Set create to make sure the shard directory exists, before writing to the path.
+    """
+    # Never let a shard point outside of the folder.
+    shard = os.path.join(folder, filename[:SHARD_WIDTH].replace(".", "_"))
+    if create:
+        os.makedirs(shard, exist_ok=True)
+    return os.path.join(shard, filename)
+
+
+def try_stat(entry: os.DirEntry) -> Optional[os.stat_result]:
+    """
+    Stat a file found by scandir, or None if it was deleted in the meantime
+    (e.g. an input that was processed, or a file deleted through the webservice).
+    """
+    try:
+        return entry.stat()
+    except FileNotFoundError:
+        return None
+
+
+def scan_sharded(folder: str) -> Iterator[os.DirEntry]:
+    """
+    Iterate over the files in a sharded folder.
+    """
+    for entry in os.scandir(folder):
+        if entry.is_dir():
+            yield from os.scandir(entry.path)
+        else:
+            # Not moved to its shard yet, see shard_folder.
+            yield entry
+
+
+def list_sharded(folder: str) -> list[str]:
+    """
+    Names of the files in a sharded folder.
+    """
+    return [entry.name for entry in scan_sharded(folder)]
+
+
+def shard_folder(folder: str) -> None:
+    """
+    Move files that are still stored directly in the folder to their shard.
+    """
+    if not os.path.isdir(folder):
+        # Nothing to move yet.
+        return
+    for entry in os.scandir(folder):
+        if entry.is_file():
+            os.replace(entry.path, shard_path(folder, entry.name, create=True))
+
+
 # make sure the upload folder exists
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
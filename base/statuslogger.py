@@ -1,7 +1,7 @@
 """
 Status objects for files at the tagger.
 These classes are wrappers around json stored in files with file names reflecting the input document to be tagged.
-StatusLoggers live in /status, ProcessStatuses live in /process.
+StatusLoggers live in /status (sharded, see shared.py), ProcessStatuses live in /process.
 
 The only purpose of the ProcessStatus is to store the PID of the process that is currently tagging the file.
 This is used to kill the process if the user wants to cancel the tagging.
@@ -26,6 +26,9 @@ import sys
 import logging
 from typing import Any, Optional
 
+# Local
+from shared import list_sharded, shard_path
+
 STATUS_FOLDER = "status"
 PROCESS_FOLDER = "process"
 
@@ -43,7 +46,7 @@ class StatusLogger:
         # initializing ProcessStatusses checks for non-existing processes and frees up the tagger
         ProcessStatus.get_all_statusloggers()
         return list(
-            map(lambda filename: StatusLogger(filename), os.listdir(STATUS_FOLDER))
+            map(lambda filename: StatusLogger(filename), list_sharded(STATUS_FOLDER))
         )
 
     @staticmethod
@@ -70,7 +73,7 @@ class StatusLogger:
 
     def __init__(self, filename: str) -> None:
         self.filename = filename
-        self.status_path: str = os.path.join(STATUS_FOLDER, filename)
+        self.status_path: str = shard_path(STATUS_FOLDER, filename)
 
     def exists(self) -> bool:
         return os.path.isfile(self.status_path)
@@ -122,6 +125,7 @@ class StatusLogger:
         """
         Logs the current status, replacing the previous one.
         """
+        os.makedirs(os.path.dirname(self.status_path), exist_ok=True)
         f = open(self.status_path, "w", encoding="utf-8")
         json.dump(status, f)
         f.close()
@@ -203,7 +207,7 @@ class ProcessStatus(StatusLogger):
 
     def get_pid(self) -> Optional[int]:
         """
-        Process ID of the current thread (i.e. mp.pool).
+        Process ID of the worker process that is tagging the file.
         """
         if not self.exists():
             return None
@@ -213,7 +217,7 @@ class ProcessStatus(StatusLogger):
 
     def kill(self) -> None:
         """
-        Kill the thread (i.e. mp.pool) that is currently tagging the file.
+        Kill the worker process that is currently tagging the file. The supervisor replaces it.
         """
         pid = self.get_pid()
         if pid is not None:
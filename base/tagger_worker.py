@@ -5,40 +5,70 @@ and sends the results to the callback server. The server then responds with KEEP
 which determines if the resulting tagged output file is kept or deleted.
 Input files are deleted automatically after processing, or moved to the error folder if processing fails.
 
-We use a multiprocessing pool to process files, because we want to kill the process if needed.
+We process files in a separate worker process, because we want to kill the process if needed.
 Additonally the taggers need to be initialized only once (and in the same thread), 
-so that can be done at pool initialization.
+so that is done when the worker process starts.
+
+The worker processes are managed by a supervisor. Workers send heartbeats, and the supervisor enforces
+the deadline of a task from the outside, because the alarm inside the worker cannot interrupt a call
+that is stuck in C code. The supervisor keeps a standby worker with an initialized tagger, so that a hung,
+crashed or killed worker is replaced without waiting for the tagger to initialize again.
+
+The supervisor also answers /tag requests of the webservice over a unix socket. Short texts are tagged
+in memory by the standby worker, or by the active worker if it is idle, bypassing the queue.
 """
 
 # Standard library
 import errno
+import json
+import logging
 import os
+import threading
 import time
 import multiprocessing as mp
-from multiprocessing.pool import Pool
-from typing import Optional
-import subprocess
+from multiprocessing.connection import Connection, Listener
+from multiprocessing.sharedctypes import Synchronized
+from multiprocessing.synchronize import Event
+from typing import Any, Optional
 import requests
 
 # Local
 import process
 from timeout import timeout
-from shared import OUTPUT_FOLDER, UPLOAD_FOLDER, ERROR_FOLDER
-from statuslogger import StatusLogger, ProcessStatus
+import retention
+from shared import OUTPUT_FOLDER, UPLOAD_FOLDER, ERROR_FOLDER, SUPERVISOR_FILE, TAG_SOCKET
+from shared import shard_path
+from statuslogger import StatusLogger, ProcessStatus, PROCESS_FOLDER
 from process import PROCESSING_SPEED
 
 CALLBACK_SERVER: str = os.getenv("CALLBACK_SERVER") or ""
+# Seconds to wait for the callback server. Errors are also sent from the supervisor, which must not hang.
+CALLBACK_TIMEOUT: float = float(os.getenv("CALLBACK_TIMEOUT") or 60)
+# Seconds between the heartbeats of a worker.
+HEARTBEAT_INTERVAL: float = float(os.getenv("HEARTBEAT_INTERVAL") or 1)
+# Seconds without a heartbeat after which an initialized worker is considered hung.
+HEARTBEAT_TIMEOUT: float = float(os.getenv("HEARTBEAT_TIMEOUT") or 60)
+# Seconds the supervisor waits past the timeout of a task before killing the worker,
+# so the timeout inside the worker gets the chance to report the error first.
+DEADLINE_GRACE: float = float(os.getenv("DEADLINE_GRACE") or 30)
+# Keep a standby worker with an initialized tagger. Costs the memory of a second tagger.
+STANDBY_WORKER: bool = (os.getenv("STANDBY_WORKER") or "true").lower() == "true"
+# Tasks smaller than this are not used to measure the throughput.
+MIN_MEASURED_BYTES = PROCESSING_SPEED
+# Fixed seconds a worker gets to tag a text for /tag before it is considered hung,
+# on top of the expected time for the size of the text (see get_text_timeout).
+TAG_TIMEOUT: float = float(os.getenv("TAG_TIMEOUT") or 10)
 
 
-def run_pending_tasks() -> None:
+def run_pending_tasks(supervisor: "Supervisor") -> None:
     """
-    Send a new task to the pool if there is no busy task.
-    If there is no pool running, start a new pool.
+    Send a new task to the active worker if it is ready and there is no busy task.
     """
-    global pool
-
     # One task at a time.
-    if StatusLogger.busy_task_exists():
+    if supervisor.is_busy() or StatusLogger.busy_task_exists():
+        return
+    # The tagger of the active worker may still be initializing.
+    if not supervisor.is_ready():
         return
 
     # Start new task when not busy
@@ -48,65 +78,109 @@ def run_pending_tasks() -> None:
         # In which case the pending_tasks list is outdated. (It will refresh, though.)
         if sl.exists():
             if sl.get_status()["busy"] is False:
-                sl.busy("Parsing file")  # Sets busy true
-                # Extra None check for typing
-                if (not is_pool_running(pool)) or pool is None:
-                    # Spawn pool if not running
-                    pool = mp.Pool(processes=1, initializer=process.init)
-                # Perform task at running pool
-                pool.apply_async(process_file, args=(sl.filename,))
+                supervisor.submit(sl)
                 # Only start one task at a time, so return.
                 return
 
 
-def process_file(filename: str):
+def queue_is_empty() -> bool:
+    """
+    Whether there are no input files waiting (or arriving) to be processed.
+    """
+    with os.scandir(UPLOAD_FOLDER) as entries:
+        return next(entries, None) is None
+
+
+def get_paths(filename: str) -> tuple[str, str, str]:
+    """
+    The input, output and error paths of a file.
+    """
+    in_path = os.path.abspath(os.path.join(UPLOAD_FOLDER, filename))
+    out_path = os.path.abspath(
+        shard_path(OUTPUT_FOLDER, filename + process.OUTPUT_EXTENSION, create=True)
+    )
+    error_path = os.path.abspath(shard_path(ERROR_FOLDER, filename, create=True))
+    return in_path, out_path, error_path
+
+
+def get_size(in_path: str) -> int:
+    # The input file might have been deleted in the meantime.
+    return os.path.getsize(in_path) if os.path.exists(in_path) else 0
+
+
+def get_timeout(in_path: str) -> int:
+    """
+    Seconds the tagger gets to process the file.
+    """
+    in_bytes_size = get_size(in_path)
+    # 300s = 5min fixed time
+    # plus
+    # bytes / speed variable time
+    return 300 + in_bytes_size // PROCESSING_SPEED
+
+
+def get_text_timeout(text: str) -> float:
+    """
+    Seconds the tagger gets to tag a text for /tag, like get_timeout for files.
+    """
+    return TAG_TIMEOUT + len(text.encode("utf-8")) / PROCESSING_SPEED
+
+
+def process_file(filename: str) -> Optional[float]:
     """
     Process a file:
     Create a ProcessStatus, set the StatusLogger to busy, send the file to the tagger with a timeout,
     and set the status once finished, and send the result to the callback server.
-    This function runs in a separate process.
+    Returns the seconds the tagger took, or None if processing failed.
+    This function runs in a worker process.
     """
     # Register the process
     ps = ProcessStatus(filename, os.getpid())
     sl = StatusLogger(filename)
 
     # Set up paths
-    in_path = os.path.abspath(os.path.join(UPLOAD_FOLDER, filename))
-    out_path = os.path.abspath(
-        os.path.join(OUTPUT_FOLDER, filename + process.OUTPUT_EXTENSION)
-    )
-    error_path = os.path.abspath(os.path.join(ERROR_FOLDER, filename))
+    in_path, out_path, _ = get_paths(filename)
 
     try:
-        tag(filename, in_path, out_path, sl, ps)
+        return tag(filename, in_path, out_path, sl, ps)
     except Exception as e:
         # Process failed, free up the pid
         ps.delete_status()
-        sl.error(f"An exception occurred: {e}")
-        # copy input file to error folder if it exists
-        if os.path.exists(in_path):
-            sl.error("Moving input file to error folder")
-            os.rename(in_path, error_path)
-        if CALLBACK_SERVER != "":
-            sl.error("Sending error to callback server")
-            send_error_to_callback_server(filename, out_path, message=str(e))
+        handle_error(filename, str(e))
+        return None
+
+
+def handle_error(filename: str, message: str) -> None:
+    """
+    Set the error status, move the input file to the error folder,
+    and send the error to the callback server.
+    """
+    sl = StatusLogger(filename)
+    in_path, out_path, error_path = get_paths(filename)
+    sl.error(f"An exception occurred: {message}")
+    # copy input file to error folder if it exists
+    if os.path.exists(in_path):
+        sl.error("Moving input file to error folder")
+        os.rename(in_path, error_path)
+    if CALLBACK_SERVER != "":
+        sl.error("Sending error to callback server")
+        # This also runs in the supervisor, which must not go down with an unreachable callback server.
+        try:
+            send_error_to_callback_server(filename, out_path, message=message)
+        except Exception as e:
+            sl.error(f"Could not send error to callback server: {e}")
 
 
 def tag(
     filename: str, in_path: str, out_path: str, sl: StatusLogger, ps: ProcessStatus
-) -> None:
+) -> float:
     """
     Attempt to tag the file by the tagger with a timeout.
     Send the result to the server, whether sucessful or not.
     Also appropiately logs the status.
+    Returns the seconds the tagger took, without the callback.
     """
-    # 300s = 5min fixed time
-    # plus
-    # bytes * speed variable time
-    in_bytes_size = int(
-        subprocess.check_output(["du", "-sb", in_path]).split()[0].decode("utf-8")
-    )
-    TIMEOUT = 300 + in_bytes_size + PROCESSING_SPEED
+    TIMEOUT = get_timeout(in_path)
     sl.busy("Will process with a timeout after " + str(TIMEOUT) + " seconds")
 
     # Runs the respective tagger software.
@@ -114,7 +188,9 @@ def tag(
     def doTagging():
         process.process(in_path, out_path)
 
+    started = time.time()
     doTagging()
+    seconds = time.time() - started
 
     # Done processing
     ps.delete_status()  # Frees up the tagger
@@ -134,6 +210,7 @@ def tag(
         send_result_to_callback_server(filename, out_path)
         sl.finished("Finished")
         sl.delete_status()
+    return seconds
 
 
 def keep_or_delete_file(response: requests.Response, out_path: str) -> None:
@@ -158,7 +235,7 @@ def send_result_to_callback_server(filename: str, out_path: str) -> None:
     url = CALLBACK_SERVER + "/result"
     payload = {"file_id": filename}
     files = {"file": file}
-    r = requests.post(url, files=files, data=payload)
+    r = requests.post(url, files=files, data=payload, timeout=CALLBACK_TIMEOUT)
     keep_or_delete_file(r, out_path)
 
 
@@ -168,32 +245,361 @@ def send_error_to_callback_server(filename: str, out_path: str, message: str) ->
     """
     url = CALLBACK_SERVER + "/error"
     payload = {"file_id": filename, "message": message}
-    r = requests.post(url, data=payload)
+    r = requests.post(url, data=payload, timeout=CALLBACK_TIMEOUT)
     keep_or_delete_file(r, out_path)
 
 
-def is_pool_running(pool: Optional[Pool]) -> bool:
+def send_heartbeats(heartbeat: Synchronized) -> None:
     """
-    Check if the pool is running by trying to execute a dummy function.
+    Let the supervisor know the worker is alive.
+    Runs in a thread of the worker process.
+    """
+    while True:
+        heartbeat.value = time.time()
+        time.sleep(HEARTBEAT_INTERVAL)
+
+
+def run_worker(conn: Connection, heartbeat: Synchronized, ready: Event) -> None:
+    """
+    Entry point of a worker process.
+    Initialize the tagger once, then process the files and texts received from the supervisor one by one.
+    """
+    threading.Thread(target=send_heartbeats, args=(heartbeat,), daemon=True).start()
+    process.init()
+    ready.set()
+    while True:
+        try:
+            kind, payload = conn.recv()
+        except EOFError:
+            # The supervisor is gone.
+            return
+        if kind == "file":
+            # Keep the worker and its initialized tagger alive, whatever happens to the task.
+            seconds = None
+            try:
+                seconds = process_file(payload)
+            except Exception as e:
+                logging.error(f"{payload} - Processing failed: {e}")
+            conn.send((payload, seconds))
+        else:
+            conn.send(tag_text(payload))
+
+
+def tag_text(text: str) -> tuple[str, str]:
+    """
+    Tag a text in memory. Returns ("ok", result) or ("error", message).
+    This function runs in a worker process.
     """
-    if pool is None:
-        return False
     try:
-        pool.apply_async(lambda: None)
-    except ValueError as e:
-        if str(e) == "Pool not running":
+        return "ok", process.process_text(text)
+    except Exception as e:
+        return "error", f"An exception occurred: {e}"
+
+
+class Worker:
+    """
+    A worker process with its own tagger, and the task it is currently processing.
+    """
+
+    def __init__(self) -> None:
+        self.heartbeat: Synchronized = mp.Value("d", time.time())
+        self.ready: Event = mp.Event()
+        self.conn, child_conn = mp.Pipe()
+        self.process = mp.Process(
+            target=run_worker, args=(child_conn, self.heartbeat, self.ready), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.task: Optional[str] = None
+        self.task_bytes: int = 0
+        self.started: float = 0
+        self.deadline: float = 0
+        # Seconds the tagger took for the last task, as reported by the worker. None if it failed.
+        self.task_seconds: Optional[float] = None
+        # Set while the worker tags a text for /tag, outside the lock of the supervisor.
+        self.tagging_text: bool = False
+
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+
+    def is_ready(self) -> bool:
+        """
+        Whether the tagger is initialized.
+        """
+        return self.ready.is_set()
+
+    def heartbeat_age(self) -> float:
+        return time.time() - self.heartbeat.value
+
+    def submit(self, filename: str, task_bytes: int, deadline: float) -> None:
+        self.task = filename
+        self.task_bytes = task_bytes
+        self.started = time.time()
+        self.deadline = self.started + deadline
+        try:
+            self.conn.send(("file", filename))
+        except BrokenPipeError:
+            # The worker died in the meantime. The supervisor reports the task as failed.
+            pass
+
+    def tag_text(self, text: str, timeout: float) -> tuple[str, str]:
+        """
+        Let the worker tag a text. Raises TimeoutError if it does not reply in time.
+        """
+        self.conn.send(("text", text))
+        if not self.conn.poll(timeout):
+            raise TimeoutError("Worker exceeded the deadline of a text")
+        return self.conn.recv()
+
+    def poll_task(self) -> bool:
+        """
+        Clear the task if the worker reported it as done. Returns whether it did.
+        """
+        if self.tagging_text:
+            # The reply belongs to the text.
             return False
-    return True
+        try:
+            if self.conn.poll():
+                _, self.task_seconds = self.conn.recv()
+                self.task = None
+                return True
+        except EOFError:
+            # The worker died, which is picked up by the supervisor.
+            pass
+        return False
+
+    def get_failure(self) -> Optional[str]:
+        """
+        The reason the worker has failed, or None if it is healthy.
+        """
+        if not self.is_alive():
+            return f"Worker exited with code {self.process.exitcode}"
+        if self.task is not None and time.time() > self.deadline:
+            return "Worker exceeded the deadline of its task"
+        if self.is_ready() and self.heartbeat_age() > HEARTBEAT_TIMEOUT:
+            return f"Worker missed heartbeats for {int(self.heartbeat_age())} seconds"
+        return None
+
+    def kill(self) -> None:
+        if self.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def get_status(self) -> dict[str, Any]:
+        return {
+            "pid": self.process.pid,
+            "alive": self.is_alive(),
+            "ready": self.is_ready(),
+            "heartbeatAge": round(self.heartbeat_age(), 1),  # seconds
+            "task": self.task,
+        }
+
 
+class Supervisor:
+    """
+    Keeps an active worker that processes the tasks, and (optionally) a standby worker to replace it.
+    Failed workers are killed and replaced, their tasks are reported as errors.
+    The workers are used from the main thread (files) and the thread serving /tag (texts), hence the lock.
+    The state of the supervisor is stored in a json file for the health endpoint of the webservice.
+    """
+
+    def __init__(self, standby: bool) -> None:
+        self.active = Worker()
+        self.standby: Optional[Worker] = Worker() if standby else None
+        self.restarts = 0
+        self.failovers = 0
+        self.last_failure: Optional[dict[str, Any]] = None
+        # Measured chars/s over the recent tasks, None until the first task has finished.
+        self.throughput: Optional[float] = None
+        self.texts = 0
+        self.lock = threading.Lock()
+
+    def is_ready(self) -> bool:
+        return self.active.is_ready()
+
+    def is_busy(self) -> bool:
+        return self.active.task is not None or self.active.tagging_text
+
+    def submit(self, sl: StatusLogger) -> bool:
+        """
+        Send the task to the active worker, unless the worker took a text for /tag in the meantime.
+        Returns whether the task was submitted. If not, it stays pending.
+        """
+        in_path, _, _ = get_paths(sl.filename)
+        with self.lock:
+            if self.is_busy() or not self.is_ready():
+                return False
+            sl.busy("Parsing file")  # Sets busy true
+            self.active.submit(
+                sl.filename, get_size(in_path), get_timeout(in_path) + DEADLINE_GRACE
+            )
+            return True
+
+    def check(self) -> None:
+        """
+        Check on the workers and replace those that have failed.
+        """
+        failed_task = None
+        with self.lock:
+            if self.active.poll_task():
+                self._measure_throughput(self.active)
+            active_failure = self.active.get_failure()
+            if active_failure is not None:
+                failed_task = self.replace_active(active_failure)
+
+            if self.standby is not None:
+                failure = self.standby.get_failure()
+                if failure is not None:
+                    self.replace_standby(failure)
+
+            self._dump_status()
+        # Outside the lock, because reporting the error may wait for the callback server.
+        if failed_task is not None:
+            fail_task(failed_task, active_failure)
+
+    def tag_text(self, text: str) -> tuple[str, str]:
+        """
+        Tag a text with the standby worker, or with the active worker if it is idle and the queue is empty,
+        so that /tag cannot starve the queue.
+        Returns ("ok", result), ("error", message) or ("busy", message) if no worker is available.
+        The lock is only held to pick the worker, so files are still checked and submitted meanwhile.
+        """
+        with self.lock:
+            standby = self.standby
+            if standby is not None and standby.is_ready() and not standby.tagging_text:
+                worker = standby
+            elif self.active.is_ready() and not self.is_busy() and queue_is_empty():
+                worker = self.active
+            else:
+                return "busy", "All workers are busy"
+            worker.tagging_text = True
+            self.texts += 1
+
+        try:
+            result = worker.tag_text(text, get_text_timeout(text))
+        except (TimeoutError, EOFError, OSError) as e:
+            reason = str(e) or "Worker died while tagging a text"
+            failed_task = None
+            with self.lock:
+                worker.tagging_text = False
+                # The worker might have been replaced by check() in the meantime.
+                if worker is self.active:
+                    failed_task = self.replace_active(reason)
+                elif worker is self.standby:
+                    self.replace_standby(reason)
+            if failed_task is not None:
+                fail_task(failed_task, reason)
+            return "error", reason
+        with self.lock:
+            worker.tagging_text = False
+        return result
 
-# Pool needs to be defined after the functions it will execute.
-# https://stackoverflow.com/questions/41385708/multiprocessing-example-giving-attributeerror#comment101561695_42383397
-pool: Optional[Pool] = mp.Pool(processes=1, initializer=process.init)
+    def serve(self) -> None:
+        """
+        Answer the /tag requests of the webservice one at a time. Runs in a thread.
+        """
+        if os.path.exists(TAG_SOCKET):
+            os.remove(TAG_SOCKET)
+        with Listener(TAG_SOCKET, family="AF_UNIX") as listener:
+            while True:
+                with listener.accept() as conn:
+                    try:
+                        conn.send(self.tag_text(conn.recv()))
+                    except (EOFError, OSError):
+                        # The webservice hung up.
+                        pass
+
+    def _measure_throughput(self, worker: Worker) -> None:
+        """
+        Update the moving average of the throughput with the task the worker just finished.
+        Only the time of the tagger counts, as reported by the worker, not the callback or the poll interval.
+        Tasks of less than a second of expected work are skipped, as their fixed overhead would dominate.
+        """
+        seconds = worker.task_seconds
+        if seconds is None or seconds <= 0 or worker.task_bytes < MIN_MEASURED_BYTES:
+            return
+        speed = worker.task_bytes / seconds
+        if self.throughput is None:
+            self.throughput = speed
+        else:
+            self.throughput = 0.8 * self.throughput + 0.2 * speed
+
+    def replace_standby(self, reason: str) -> None:
+        logging.error(f"Standby worker failed: {reason}")
+        self.standby.kill()
+        self.standby = Worker()
+        self.restarts += 1
+        self.last_failure = {"time": time.time(), "reason": reason, "task": None}
+
+    def replace_active(self, reason: str) -> Optional[str]:
+        """
+        Replace the failed active worker. Returns its task, which the caller reports with fail_task
+        once it has released the lock.
+        """
+        failed = self.active
+        task = failed.task
+        logging.error(f"Active worker failed: {reason}")
+        failed.kill()
+        if self.standby is not None:
+            # The standby already has an initialized tagger, so it can take over right away.
+            self.active = self.standby
+            self.standby = Worker()
+            self.failovers += 1
+        else:
+            self.active = Worker()
+        self.restarts += 1
+        self.last_failure = {"time": time.time(), "reason": reason, "task": task}
+        return task
+
+    def get_status(self) -> dict[str, Any]:
+        return {
+            "active": self.active.get_status(),
+            "standby": self.standby.get_status() if self.standby else None,
+            "restarts": self.restarts,
+            "failovers": self.failovers,
+            "lastFailure": self.last_failure,
+            "throughput": self.throughput,  # char/s
+            "texts": self.texts,  # tagged for /tag
+        }
+
+    def _dump_status(self) -> None:
+        """
+        Write the status to a temporary file first, so the webservice never reads a partial file.
+        """
+        tmp_path = SUPERVISOR_FILE + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.get_status(), f)
+        os.replace(tmp_path, SUPERVISOR_FILE)
+
+
+def fail_task(filename: str, reason: str) -> None:
+    """
+    Handle the task of a worker that was killed by the supervisor, or that died.
+    """
+    if not StatusLogger(filename).exists():
+        # The task was cancelled, which is what killed the worker.
+        logging.info(f"{filename} - Worker stopped for cancelled task")
+        return
+    # Remove the process status of the dead worker directly.
+    # Initializing a ProcessStatus would reset the task to pending.
+    process_path = os.path.join(PROCESS_FOLDER, filename)
+    if os.path.exists(process_path):
+        os.remove(process_path)
+    if StatusLogger(filename).get_status()["error"]:
+        # The worker already reported the error before it died.
+        logging.info(f"{filename} - Worker stopped after reporting an error")
+        return
+    handle_error(filename, reason)
 
 
 # It is ugly, but it is also used here:
 # https://pypi.org/project/schedule/
 if __name__ == "__main__":
+    retention.start()
+    supervisor = Supervisor(standby=STANDBY_WORKER)
+    threading.Thread(target=supervisor.serve, daemon=True).start()
     while True:
-        run_pending_tasks()
+        supervisor.check()
+        run_pending_tasks(supervisor)
         time.sleep(1)
@@ -0,0 +1,101 @@
+"""
+Stream the file part of a multipart/form-data request body directly to disk.
+
+Bottle first spools the whole request body and then parses it into temporary files,
+so a large upload is written to disk several times before it reaches the input folder.
+Here the body is read from the socket in chunks and only the file part is written, once.
+"""
+
+# Standard library
+import os
+from email.message import Message
+from email.parser import HeaderParser
+from typing import BinaryIO, Iterator, Optional
+
+CHUNK_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    pass
+
+
+def _read_chunks(stream: BinaryIO, content_length: int) -> Iterator[bytes]:
+    remaining = content_length
+    while remaining > 0:
+        chunk = stream.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            raise UploadError("Request body ended early")
+        remaining -= len(chunk)
+        yield chunk
+
+
+def get_boundary(content_type: str) -> bytes:
+    message = Message()
+    message["content-type"] = content_type
+    boundary = message.get_param("boundary")
+    if message.get_content_type() != "multipart/form-data" or not boundary:
+        raise UploadError("Expected a multipart/form-data request")
+    return str(boundary).encode("latin-1")
+
+
+def save_file_part(
+    stream: BinaryIO, content_type: str, content_length: int, field: str, path: str
+) -> Optional[str]:
+    """
+    Write the contents of the file part named field to path.
+    Returns the filename sent by the client, or None if there is no such file part.
+    """
+    boundary = b"--" + get_boundary(content_type)
+    # Within the body, a boundary is always preceded by a line break.
+    delimiter = b"\r\n" + boundary
+    chunks = _read_chunks(stream, content_length)
+    buffer = b""
+
+    def fill() -> None:
+        nonlocal buffer
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise UploadError("Malformed multipart body")
+        buffer += chunk
+
+    # Skip the preamble.
+    while (i := buffer.find(boundary)) < 0:
+        fill()
+    buffer = buffer[i + len(boundary) :]
+
+    while True:
+        while len(buffer) < 2:
+            fill()
+        if buffer.startswith(b"--"):
+            # Closing boundary.
+            return None
+
+        while (i := buffer.find(b"\r\n\r\n")) < 0:
+            fill()
+        headers = HeaderParser().parsestr(buffer[2:i].decode("utf-8", "replace"))
+        buffer = buffer[i + 4 :]
+        name = headers.get_param("name", header="content-disposition")
+        filename = headers.get_filename()
+        is_file = name == field and filename is not None
+
+        f = open(path, "wb") if is_file else None
+        try:
+            while (i := buffer.find(delimiter)) < 0:
+                # Keep enough bytes to find a delimiter that spans two chunks.
+                safe = len(buffer) - len(delimiter)
+                if safe > 0:
+                    if f is not None:
+                        f.write(buffer[:safe])
+                    buffer = buffer[safe:]
+                fill()
+            if f is not None:
+                f.write(buffer[:i])
+        except:
+            if f is not None:
+                f.close()
+                os.remove(path)
+            raise
+        buffer = buffer[i + len(delimiter) :]
+        if f is not None:
+            f.close()
+            return filename
@@ -10,20 +10,40 @@ Deleting files also stops the tagger if that file was being processed.
 """
 
 # Standard library
+import json
+import math
 import os
+import shutil
 import subprocess
 import uuid
+from multiprocessing.connection import Client
+from typing import Optional
 
 # Third-party
 import bottle
-from bottle import HTTPResponse, request, request, static_file, FileUpload
+from bottle import HTTPResponse, request, request, static_file
 from bottle import post, get, delete
 
 # Local
-from shared import OUTPUT_FOLDER, UPLOAD_FOLDER, ERROR_FOLDER
-from statuslogger import StatusLogger
+from shared import OUTPUT_FOLDER, UPLOAD_FOLDER, ERROR_FOLDER, SUPERVISOR_FILE
+from shared import RETENTION_FILE, TAG_SOCKET, list_sharded, shard_path, try_stat
+from statuslogger import StatusLogger, STATUS_FOLDER
+from retention import get_usage
+from upload import save_file_part, UploadError
 from process import OUTPUT_EXTENSION, PROCESSING_SPEED
 
+# Admission control on uploads, 0 disables a limit.
+# Maximum size of a single upload in bytes.
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES") or 0)
+# Maximum number of files in the queue.
+MAX_QUEUE_FILES = int(os.getenv("MAX_QUEUE_FILES") or 0)
+# Maximum total size of the files in the queue in bytes.
+MAX_QUEUE_BYTES = int(os.getenv("MAX_QUEUE_BYTES") or 0)
+# Minimum free disk space in bytes that must remain after an upload.
+MIN_FREE_BYTES = int(os.getenv("MIN_FREE_BYTES") or 0)
+# Maximum size of a text for /tag in bytes.
+TAG_MAX_BYTES = int(os.getenv("TAG_MAX_BYTES") or 10000)
+
 app = application = bottle.default_app()
 
 
@@ -33,7 +53,10 @@ def main():
     <p>Any file will be interpreted as plain text.</p>
     <p>[GET /health] health check endpoint</p>
     <p>[GET /input] get an upload form (for convenience)</p>
-    <p>[POST /input] upload a file for processing. Returns an identifier for the uploaded file.</p>
+    <p>[POST /input] upload a file for processing. Returns an identifier for the uploaded file.
+    Returns 413 if the file is too large, or 429/503 with Retry-After if the tagger is too busy.</p>
+    <p>[POST /tag] tag a short text (the request body, or form field "text") right away, bypassing the queue.
+    Returns tsv, or json rows with ?format=json.</p>
     <p>[DELETE /input/FILE_IDENTIFIER] delete input file with FILE_IDENTIFIER from server.</p>
     <p>[GET /status] get a dict with the status of files</p>
     <p>[GET /status/FILE_IDENTIFIER] get status for file with FILE_IDENTIFIER</p>
@@ -42,6 +65,7 @@ def main():
     <p>[GET /output] get a list of processed files</p>
     <p>[GET /output/FILE_IDENTIFIER] download processed file FILE_IDENTIFIER</p>
     <p>[DELETE /output/FILE_IDENTIFIER] delete file with FILE_IDENTIFIER from server</p>
+    <p>[GET /admin/disk] get the disk usage and the result of the last retention run</p>
     """
 
 
@@ -56,10 +80,23 @@ def health():
         "healthy": True,
         "queueSizeAtTagger": queue_size,  # bytes, but mostly ascii so 1 byte is 1 char.
         "processingSpeed": PROCESSING_SPEED,  # char/s
+        # bytes, 0 if unlimited. Lets a dispatcher refuse an upload before reading it.
+        "maxUploadBytes": get_max_upload_bytes() or 0,
+        "supervisor": get_supervisor_status(),  # workers, restarts and failovers
         "message": "I am healthy.",
     }
 
 
+def get_supervisor_status():
+    """
+    The status written by the supervisor of the tagger worker, or None if it is not running yet.
+    """
+    if not os.path.isfile(SUPERVISOR_FILE):
+        return None
+    with open(SUPERVISOR_FILE, encoding="utf-8") as f:
+        return json.load(f)
+
+
 @get("/input")
 # upload form for convenience
 def handle_file():
@@ -74,25 +111,142 @@ def handle_file():
     """
 
 
+def get_queue() -> tuple[int, int]:
+    """
+    Number of files and their total size in bytes in the queue.
+    """
+    # The worker deletes inputs once they are processed, possibly between listing and stat.
+    stats = [try_stat(entry) for entry in os.scandir(UPLOAD_FOLDER)]
+    sizes = [stat.st_size for stat in stats if stat is not None]
+    return len(sizes), sum(sizes)
+
+
+def get_throughput() -> float:
+    """
+    Throughput in chars/s as measured by the supervisor, or the expected throughput if there is no measurement yet.
+    """
+    supervisor = get_supervisor_status()
+    if supervisor is None or not supervisor.get("throughput"):
+        return PROCESSING_SPEED
+    return supervisor["throughput"]
+
+
+def too_busy(status: int, message: str, seconds: float) -> HTTPResponse:
+    retry_after = max(1, math.ceil(seconds))
+    return HTTPResponse(
+        f"{message}, retry after {retry_after} seconds",
+        status,
+        **{"Retry-After": str(retry_after)},
+    )
+
+
+def get_max_upload_bytes() -> Optional[int]:
+    """
+    The largest upload that is not refused right away, or None if there is no limit.
+    """
+    limits = [b for b in [MAX_UPLOAD_BYTES, MAX_QUEUE_BYTES] if b > 0]
+    return min(limits) if limits else None
+
+
+def admit(upload_bytes: int) -> Optional[HTTPResponse]:
+    """
+    Refuse the upload if it is too large, if the queue is full, or if the disk is almost full.
+    Returns the refusal, or None if the upload is admitted.
+    When the tagger is too busy, Retry-After estimates how long the backlog needs to make room.
+    """
+    if upload_bytes < 0:
+        return HTTPResponse("Content-Length required", 411)
+    max_bytes = get_max_upload_bytes()
+    if max_bytes is not None and upload_bytes > max_bytes:
+        return HTTPResponse(f"File is larger than {max_bytes} bytes", 413)
+
+    queue_files, queue_bytes = get_queue()
+    throughput = get_throughput()
+    if MAX_QUEUE_FILES > 0 and queue_files >= MAX_QUEUE_FILES:
+        # Wait for the surplus files, assuming they have the average size.
+        surplus = (queue_files - MAX_QUEUE_FILES + 1) * queue_bytes / queue_files
+        return too_busy(429, "Queue is full", surplus / throughput)
+    if MAX_QUEUE_BYTES > 0 and queue_bytes + upload_bytes > MAX_QUEUE_BYTES:
+        surplus = queue_bytes + upload_bytes - MAX_QUEUE_BYTES
+        return too_busy(429, "Queue is full", surplus / throughput)
+    if MIN_FREE_BYTES > 0:
+        free = shutil.disk_usage(UPLOAD_FOLDER).free
+        if free - upload_bytes < MIN_FREE_BYTES:
+            # Processing the backlog frees the input files.
+            return too_busy(503, "Disk is almost full", queue_bytes / throughput)
+    return None
+
+
 @post("/input")
 def post_input():
+    # Refuse before reading the body.
+    refusal = admit(request.content_length)
+    if refusal is not None:
+        return refusal
+
+    id = str(uuid.uuid4())
+    path = os.path.join(UPLOAD_FOLDER, id)
+    try:
+        filename = save_file_part(
+            request.environ["wsgi.input"],
+            request.content_type,
+            request.content_length,
+            "file",
+            path,
+        )
+    except UploadError as e:
+        return HTTPResponse(str(e), 400)
     # check if the post request has the file part
-    if "file" not in request.files:
+    if filename is None:
         return HTTPResponse("No file part", 400)
-    file: FileUpload = request.files["file"]
     # If the user does not select a file, the browser submits an
     # empty file without a filename.
-    if file.filename == "":
+    if filename == "":
+        os.remove(path)
         return HTTPResponse("No selected file", 400)
-    if file:
-        id = str(uuid.uuid4())
-        file.save(os.path.join(UPLOAD_FOLDER, id))
-        # register the file
-        sl = StatusLogger(id)
-        sl.init("File arrived")
-        return id
-    else:
-        return HTTPResponse("File is not defined", 400)
+    # register the file
+    sl = StatusLogger(id)
+    sl.init("File arrived")
+    return id
+
+
+@post("/tag")
+def post_tag():
+    if request.content_length < 0:
+        return HTTPResponse("Content-Length required", 411)
+    if request.content_length > TAG_MAX_BYTES:
+        return HTTPResponse(
+            f"Text is larger than {TAG_MAX_BYTES} bytes, upload it to /input instead", 413
+        )
+    # Form field "text", or else the whole body.
+    text = request.forms.getunicode("text")
+    if text is None:
+        try:
+            text = request.body.read().decode("utf-8")
+        except UnicodeDecodeError:
+            return HTTPResponse("Text must be UTF-8", 400)
+
+    # The supervisor in the tagger worker hands the text to an idle worker.
+    try:
+        with Client(TAG_SOCKET, family="AF_UNIX") as conn:
+            conn.send(text)
+            result, message = conn.recv()
+    except (OSError, EOFError):
+        return HTTPResponse("Tagger worker is not running", 503)
+    if result == "busy":
+        # The workers become available once the queue is processed.
+        _, queue_bytes = get_queue()
+        return too_busy(503, message, queue_bytes / get_throughput())
+    if result == "error":
+        return HTTPResponse(message, 500)
+
+    if request.query.get("format") == "json":
+        lines = [line.split("\t") for line in message.splitlines() if line]
+        if len(lines) == 0:
+            return {"rows": []}
+        header, rows = lines[0], lines[1:]
+        return {"rows": [dict(zip(header, row)) for row in rows]}
+    return HTTPResponse(message, 200, **{"Content-Type": "text/tab-separated-values; charset=UTF-8"})
 
 
 @delete("/input/<id>")
@@ -120,25 +274,25 @@ def get_status_for(id: str):
 
 @get("/error")
 def get_error_files():
-    return {"error_files": os.listdir(ERROR_FOLDER)}
+    return {"error_files": list_sharded(ERROR_FOLDER)}
 
 
 @get("/error/<id>")
 def get_error_file(id: str):
-    filename = id
-    return static_file(filename, ERROR_FOLDER)
+    path = shard_path(ERROR_FOLDER, id)
+    return static_file(os.path.basename(path), os.path.dirname(path))
     # what to do if the file doesn't exists?
 
 
 @get("/output")
 def get_processed_files():
-    return {"processed_files": os.listdir(OUTPUT_FOLDER)}
+    return {"processed_files": list_sharded(OUTPUT_FOLDER)}
 
 
 @get("/output/<id>")
 def get_processed_file(id: str):
-    filename = id + OUTPUT_EXTENSION
-    return static_file(filename, OUTPUT_FOLDER)
+    path = shard_path(OUTPUT_FOLDER, id + OUTPUT_EXTENSION)
+    return static_file(os.path.basename(path), os.path.dirname(path))
     # what to do if the file doesn't exists?
 
 
@@ -147,7 +301,7 @@ def delete_file(id: str):
     """
     Delete the file, its associated status, and stop the processing if it is running.
     """
-    path = os.path.join(OUTPUT_FOLDER, id + OUTPUT_EXTENSION)
+    path = shard_path(OUTPUT_FOLDER, id + OUTPUT_EXTENSION)
 
     # remove the status
     sl = StatusLogger(id)
@@ -160,4 +314,24 @@ def delete_file(id: str):
         return HTTPResponse("File " + id + " deleted", 200)
 
 
+@get("/admin/disk")
+def get_disk_usage():
+    """
+    Disk usage of the volume and of each folder, and the result of the last retention run.
+    """
+    total, used, free = shutil.disk_usage(".")
+    last_run = None
+    if os.path.isfile(RETENTION_FILE):
+        with open(RETENTION_FILE, encoding="utf-8") as f:
+            last_run = json.load(f)
+    return {
+        "disk": {"total": total, "used": used, "free": free},  # bytes
+        "folders": {
+            folder: get_usage(folder)
+            for folder in [UPLOAD_FOLDER, OUTPUT_FOLDER, ERROR_FOLDER, STATUS_FOLDER]
+        },
+        "lastRetentionRun": last_run,
+    }
+
+
 app.run(host="0.0.0.0", port=8080)
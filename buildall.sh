@@ -6,6 +6,9 @@ echo "Will build taggers with version <$VERSION_LABEL>. Set VERSION_LABEL to ove
 # Base image
 docker build -t instituutnederlandsetaal/taggers-dockerized-base:$VERSION_LABEL base
 
+# Dispatcher
+docker build -t instituutnederlandsetaal/taggers-dockerized-dispatcher:$VERSION_LABEL dispatcher
+
 # PIE
 docker build -t instituutnederlandsetaal/taggers-dockerized-pie-base:$VERSION_LABEL pie/base
 docker build -t instituutnederlandsetaal/taggers-dockerized-pie-tdn-1400-1600:$VERSION_LABEL pie/TDN-1400-1600
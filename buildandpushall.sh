@@ -8,6 +8,9 @@ echo "Will build taggers with version <$VERSION_LABEL>. Set VERSION_LABEL to ove
 # Base image
 docker push instituutnederlandsetaal/taggers-dockerized-base:$VERSION_LABEL
 
+# Dispatcher
+docker push instituutnederlandsetaal/taggers-dockerized-dispatcher:$VERSION_LABEL
+
 # PIE
 docker push instituutnederlandsetaal/taggers-dockerized-pie-base:$VERSION_LABEL
 docker push instituutnederlandsetaal/taggers-dockerized-pie-tdn-1400-1600:$VERSION_LABEL
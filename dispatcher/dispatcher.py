@@ -0,0 +1,381 @@
+"""
+Web API in front of replicas of the same tagger, with the same endpoints as the tagger itself.
+
+Each upload is sent to the replica with the lowest predicted completion time,
+i.e. its queue size plus the size of the upload, divided by its speed (both from /health).
+The speed is the throughput measured by the supervisor of the replica, or else its expected processing speed.
+The replica that owns a file identifier is stored in the jobs folder,
+so that requests for the status and output of a file reach the right replica.
+Replicas send their results to the callback server themselves.
+"""
+
+# Standard library
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+
+# Third-party
+import bottle
+import requests
+from bottle import HTTPResponse, request
+from bottle import post, get, delete
+
+# Comma separated base urls of the replicas, e.g. http://tagger-1:8080,http://tagger-2:8080
+REPLICAS: list[str] = [
+    url.strip().rstrip("/") for url in (os.getenv("REPLICAS") or "").split(",") if url
+]
+# Seconds to wait for the health of a replica.
+HEALTH_TIMEOUT: float = float(os.getenv("HEALTH_TIMEOUT") or 2)
+# Seconds to wait for a replica to answer any other request.
+FORWARD_TIMEOUT: float = float(os.getenv("FORWARD_TIMEOUT") or 60)
+# Seconds the health of the replicas is reused by /tag,
+# so a short text does not wait for /health (and its disk usage check) at every replica.
+HEALTH_CACHE_SECONDS: float = float(os.getenv("HEALTH_CACHE_SECONDS") or 5)
+# One file per file identifier, containing the url of the replica that owns it.
+JOBS_FOLDER = "jobs"
+# Seconds after which the owner of a file is forgotten. By then the replica has deleted the file itself,
+# so the default is a day longer than the default OUTPUT_TTL of the replicas.
+JOBS_TTL: float = float(os.getenv("JOBS_TTL") or 8 * 24 * 60 * 60)
+# Seconds between sweeps of the jobs folder.
+SWEEP_INTERVAL = 3600
+
+if not os.path.exists(JOBS_FOLDER):
+    os.makedirs(JOBS_FOLDER)
+
+app = application = bottle.default_app()
+
+# Time of the last health check, and its result.
+health_cache: tuple[float, dict[str, Optional[dict[str, Any]]]] = (0, {})
+
+
+def get_owner(id: str) -> Optional[str]:
+    path = os.path.join(JOBS_FOLDER, id)
+    if not os.path.isfile(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def set_owner(id: str, replica: str) -> None:
+    with open(os.path.join(JOBS_FOLDER, id), "w", encoding="utf-8") as f:
+        f.write(replica)
+
+
+def delete_owner(id: str) -> None:
+    path = os.path.join(JOBS_FOLDER, id)
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def sweep_owners() -> None:
+    """
+    Forget the owners of files older than JOBS_TTL, which are only removed by DELETE otherwise.
+    """
+    now = time.time()
+    for entry in os.scandir(JOBS_FOLDER):
+        try:
+            if now - entry.stat().st_mtime > JOBS_TTL:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            # Deleted through DELETE in the meantime.
+            pass
+
+
+def run_sweeps() -> None:
+    while True:
+        try:
+            sweep_owners()
+        except Exception as e:
+            # Try again next interval.
+            logging.error(f"Sweeping the jobs folder failed: {e}")
+        time.sleep(SWEEP_INTERVAL)
+
+
+def get_health(replica: str) -> Optional[dict[str, Any]]:
+    """
+    The health of a replica, or None if it is unreachable or unhealthy.
+    """
+    try:
+        health = requests.get(replica + "/health", timeout=HEALTH_TIMEOUT).json()
+    except Exception:
+        return None
+    return health if health.get("healthy") else None
+
+
+def get_all_health(max_age: float = 0) -> dict[str, Optional[dict[str, Any]]]:
+    """
+    The health of each replica. Reuses the last check if it is younger than max_age seconds.
+    """
+    global health_cache
+    checked, health = health_cache
+    if time.time() - checked < max_age:
+        return health
+    with ThreadPoolExecutor(max_workers=max(len(REPLICAS), 1)) as executor:
+        health = dict(zip(REPLICAS, executor.map(get_health, REPLICAS)))
+    health_cache = (time.time(), health)
+    return health
+
+
+def get_speed(health: dict[str, Any]) -> float:
+    """
+    Chars/s of a replica: measured over its recent tasks if it has finished any, else the expected speed.
+    """
+    supervisor = health.get("supervisor") or {}
+    return supervisor.get("throughput") or health["processingSpeed"]
+
+
+def accepts(health: dict[str, Any], upload_size: int) -> bool:
+    """
+    Whether the replica accepts an upload of upload_size bytes, according to its health.
+    """
+    max_bytes = health.get("maxUploadBytes") or 0
+    return max_bytes == 0 or upload_size <= max_bytes
+
+
+def rank_replicas(
+    all_health: dict[str, Optional[dict[str, Any]]], upload_size: int
+) -> list[str]:
+    """
+    Healthy replicas that accept an upload of upload_size bytes, ordered by its predicted completion time.
+    """
+    predictions = []
+    for replica, health in all_health.items():
+        if health is None or not accepts(health, upload_size):
+            continue
+        seconds = (health["queueSizeAtTagger"] + upload_size) / get_speed(health)
+        predictions.append((seconds, replica))
+    return [replica for _, replica in sorted(predictions)]
+
+
+def forward(method: str, replica: str, path: str) -> requests.Response:
+    return requests.request(method, replica + path, timeout=FORWARD_TIMEOUT)
+
+
+def to_http_response(r: requests.Response) -> HTTPResponse:
+    headers = {
+        key: r.headers[key]
+        for key in ["Content-Type", "Content-Disposition", "Retry-After"]
+        if key in r.headers
+    }
+    return HTTPResponse(r.content, r.status_code, **headers)
+
+
+def forward_to_owner(method: str, id: str, path: str) -> HTTPResponse:
+    """
+    Forward the request to the replica that owns the file.
+    """
+    owner = get_owner(id)
+    if owner is None:
+        return HTTPResponse("File is not defined", 400)
+    try:
+        return to_http_response(forward(method, owner, path))
+    except requests.ConnectionError:
+        return HTTPResponse("Replica " + owner + " is unreachable", 502)
+    except requests.Timeout:
+        return HTTPResponse("Replica " + owner + " did not answer in time", 504)
+
+
+def merge_lists(path: str, key: str) -> dict[str, list[str]]:
+    """
+    Merge the lists of files of all reachable replicas.
+    """
+    ret = []
+    for replica in REPLICAS:
+        try:
+            ret.extend(forward("GET", replica, path).json()[key])
+        except Exception:
+            pass
+    return {key: ret}
+
+
+@get("/")
+def main():
+    return """
+    <p>Dispatcher for replicas of the same tagger. Any file will be interpreted as plain text.</p>
+    <p>[GET /health] health check endpoint, with the health of each replica</p>
+    <p>[GET /input] get an upload form (for convenience)</p>
+    <p>[POST /input] upload a file for processing. Returns an identifier for the uploaded file.</p>
+    <p>[POST /tag] tag a short text right away at the first replica with an idle tagger.</p>
+    <p>[DELETE /input/FILE_IDENTIFIER] delete input file with FILE_IDENTIFIER from server.</p>
+    <p>[GET /status] get a dict with the status of files</p>
+    <p>[GET /status/FILE_IDENTIFIER] get status for file with FILE_IDENTIFIER</p>
+    <p>[GET /error] get a list files with errors</p>
+    <p>[GET /error/FILE_IDENTIFIER] download file with FILE_IDENTIFIER from server</p>
+    <p>[GET /output] get a list of processed files</p>
+    <p>[GET /output/FILE_IDENTIFIER] download processed file FILE_IDENTIFIER</p>
+    <p>[DELETE /output/FILE_IDENTIFIER] delete file with FILE_IDENTIFIER from server</p>
+    """
+
+
+@get("/health")
+def health():
+    replicas = get_all_health()
+    healthy = [h for h in replicas.values() if h is not None]
+    return {
+        "healthy": len(healthy) > 0,
+        "queueSizeAtTagger": sum(h["queueSizeAtTagger"] for h in healthy),  # bytes
+        # The replicas process in parallel, so their speeds add up.
+        "processingSpeed": sum(h["processingSpeed"] for h in healthy),  # char/s
+        "replicas": replicas,
+        "message": f"{len(healthy)} of {len(REPLICAS)} replicas are healthy.",
+    }
+
+
+@get("/input")
+# upload form for convenience
+def handle_file():
+    return """
+    <!doctype html>
+    <title>Upload new File</title>
+    <h1>Upload new File</h1>
+    <form method=post enctype=multipart/form-data>
+      <input type=file name=file>
+      <input type=submit value=Upload>
+    </form>
+    """
+
+
+@post("/input")
+def post_input():
+    """
+    Forward the upload to the replicas in order of their predicted completion time,
+    until one of them accepts it. The size is checked against the limits of the replicas
+    before the body is read. The body is passed on as is, without parsing it.
+    """
+    upload_size = request.content_length
+    if upload_size < 0:
+        return HTTPResponse("Content-Length required", 411)
+    all_health = get_all_health()
+    healthy = [health for health in all_health.values() if health is not None]
+    if len(healthy) == 0:
+        return HTTPResponse("No healthy replicas", 503)
+    replicas = rank_replicas(all_health, upload_size)
+    if len(replicas) == 0:
+        max_bytes = max(health["maxUploadBytes"] for health in healthy)
+        return HTTPResponse(f"File is larger than {max_bytes} bytes", 413)
+
+    # Bottle spools a large body to a temporary file, so it can be sent again to the next replica.
+    body = request.body
+    headers = {"Content-Type": request.content_type}
+    # A replica might refuse the upload when it is full, in which case we try the next best one.
+    r = None
+    for replica in replicas:
+        body.seek(0)
+        try:
+            r = requests.post(
+                replica + "/input", data=body, headers=headers, timeout=FORWARD_TIMEOUT
+            )
+        except requests.ConnectionError:
+            continue
+        except requests.Timeout:
+            # The replica might still store the file, so do not send it to another one as well.
+            return HTTPResponse("Replica " + replica + " did not answer in time", 504)
+        if r.status_code == 200:
+            set_owner(r.text, replica)
+            return r.text
+        if r.status_code not in [429, 503]:
+            break
+    if r is None:
+        return HTTPResponse("No reachable replicas", 503)
+    return to_http_response(r)
+
+
+@post("/tag")
+def post_tag():
+    """
+    Forward the text to the replicas in order of their predicted completion time,
+    until one of them has an idle tagger. The order may be a few seconds old,
+    which is fine because a busy replica answers 503 right away.
+    """
+    body = request.body.read()
+    headers = {"Content-Type": request.content_type}
+    r = None
+    for replica in rank_replicas(get_all_health(HEALTH_CACHE_SECONDS), 0):
+        try:
+            r = requests.post(
+                replica + "/tag",
+                data=body,
+                headers=headers,
+                params=dict(request.query),
+                timeout=FORWARD_TIMEOUT,
+            )
+        except requests.ConnectionError:
+            continue
+        except requests.Timeout:
+            return HTTPResponse("Replica " + replica + " did not answer in time", 504)
+        if r.status_code != 503:
+            break
+    if r is None:
+        return HTTPResponse("No reachable replicas", 503)
+    return to_http_response(r)
+
+
+@delete("/input/<id>")
+def delete_input(id: str):
+    response = forward_to_owner("DELETE", id, "/input/" + id)
+    if response.status_code == 200:
+        delete_owner(id)
+    return response
+
+
+@get("/status")
+def get_status():
+    ret = {}
+    for replica in REPLICAS:
+        try:
+            ret.update(forward("GET", replica, "/status").json())
+        except Exception:
+            pass
+    return ret
+
+
+@get("/status/<id>")
+def get_status_for(id: str):
+    response = forward_to_owner("GET", id, "/status/" + id)
+    if response.status_code == 400:
+        # Same as the tagger itself for unknown files.
+        return {
+            "message": "File not on server",
+            "pending": False,
+            "busy": False,
+            "error": False,
+            "finished": False,
+        }
+    return response
+
+
+@get("/error")
+def get_error_files():
+    return merge_lists("/error", "error_files")
+
+
+@get("/error/<id>")
+def get_error_file(id: str):
+    return forward_to_owner("GET", id, "/error/" + id)
+
+
+@get("/output")
+def get_processed_files():
+    return merge_lists("/output", "processed_files")
+
+
+@get("/output/<id>")
+def get_processed_file(id: str):
+    return forward_to_owner("GET", id, "/output/" + id)
+
+
+@delete("/output/<id>")
+def delete_file(id: str):
+    """
+    Delete the file at its replica, and forget which replica owned it.
+    """
+    response = forward_to_owner("DELETE", id, "/output/" + id)
+    delete_owner(id)
+    return response
+
+
+threading.Thread(target=run_sweeps, daemon=True).start()
+app.run(host="0.0.0.0", port=8080)
@@ -0,0 +1,66 @@
+"""
+Benchmark the throughput of the pie tagger in chars/s.
+Run it in a pie model image, which contains the model.tar:
+
+    python benchmark.py FILE [FILE ...]
+
+Each file is tagged once per configuration below. The outputs of the configurations
+are compared byte for byte with the output of the first one.
+"""
+
+# Standard library
+import filecmp
+import os
+import sys
+import tempfile
+import time
+
+# Local
+import process
+
+# Name and process.py settings of each configuration.
+CONFIGURATIONS = [
+    ("serial", {"PREFETCH_BATCHES": 0, "SORT_WINDOW": 0}),
+    ("pipelined", {"PREFETCH_BATCHES": 4, "SORT_WINDOW": 0}),
+    ("pipelined, sorted by length", {"PREFETCH_BATCHES": 4, "SORT_WINDOW": 1000}),
+]
+
+
+def benchmark(in_file: str) -> bool:
+    """
+    Tag the file with each configuration, print the throughput and return whether all outputs are identical.
+    """
+    with open(in_file, encoding="utf-8") as f:
+        chars = len(f.read())
+    identical = True
+    with tempfile.TemporaryDirectory() as temp_dir:
+        baseline = None
+        for name, settings in CONFIGURATIONS:
+            for setting, value in settings.items():
+                setattr(process, setting, value)
+            out_file = os.path.join(temp_dir, name + process.OUTPUT_EXTENSION)
+            start = time.perf_counter()
+            process.process(in_file, out_file)
+            seconds = time.perf_counter() - start
+            print(f"{in_file} [{name}]: {chars / seconds:.0f} chars/s ({seconds:.2f}s)")
+
+            if baseline is None:
+                baseline = out_file
+            elif not filecmp.cmp(baseline, out_file, shallow=False):
+                print(f"{in_file} [{name}]: output differs from [{CONFIGURATIONS[0][0]}]")
+                identical = False
+    return identical
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: " + sys.argv[0] + " FILE [FILE ...]")
+        exit(0)
+
+    process.init()
+    # Warm up, so the first configuration is not penalized.
+    with tempfile.TemporaryDirectory() as temp_dir:
+        process.process(sys.argv[1], os.path.join(temp_dir, "warmup"))
+
+    results = [benchmark(in_file) for in_file in sys.argv[1:]]
+    exit(0 if all(results) else 1)
@@ -2,25 +2,41 @@
 Initialize the pie tagger from the python class directly, and use that object to tag.
 We use this method instead of calling 'pie tag' on the commandline, 
 because we want to avoid the overhead of reinitializing the tagger.
+
+Reading, tokenizing, batching and packing the input into tensors runs in a producer thread that stays
+a few batches ahead of the inference, so the model does not sit idle during preprocessing.
+For that, tagger.tag is split in pack and tag_packed. Torch releases the GIL during
+inference, so a thread suffices. (The tagger runs in a daemon process, which cannot start processes.)
 """
 
 # Standard library
+import io
+import itertools
 import os
+import queue
 import shutil
-import tempfile
 import sys
+import tempfile
+import threading
+from typing import Any, Iterator, TextIO
 
 # Some path magic to import pie.
 # Because pie mixes all kinds of absolute and relative imports.
 script_dir = os.path.dirname(os.path.realpath(__file__))
 sys.path.insert(0, os.path.join(script_dir, "pie"))
 
-from pie.tagger import Tagger
+from pie.data import pack_batch
+from pie.tagger import Tagger, lines_from_file
 
 # The extension of output files produced by the tagger.
 OUTPUT_EXTENSION = ".tsv"
 # Expected throughput in chars per sec.
 PROCESSING_SPEED = 370
+# Number of batches the producer thread may prepare ahead of the inference. 0 disables the thread.
+PREFETCH_BATCHES = int(os.getenv("PREFETCH_BATCHES") or 4)
+# Number of consecutive sentences that are sorted by length before batching, so that a long sentence
+# does not pad a batch of short ones. The output keeps the document order. 0 disables sorting.
+SORT_WINDOW = int(os.getenv("SORT_WINDOW") or 0)
 # Global tagger for the sake of initialization.
 tagger = None
 
@@ -38,20 +54,179 @@ def init() -> None:
     print("Model initialized.")
 
 
+def get_batches(
+    in_file: str,
+) -> Iterator[tuple[Any, Any, list[Any], list[int], bool]]:
+    """
+    Tokenize the file and split it in batches, as tagger.tag_file does.
+    A batch consists of the sentences, their lengths, the packed input of each model,
+    their positions in the window, and whether it is the last batch of the window.
+    """
+    lines = lines_from_file(
+        in_file,
+        tokenize=tagger.tokenize,
+        max_sent_len=tagger.max_sent_len,
+        vrt=tagger.vrt,
+    )
+    window_size = max(SORT_WINDOW, tagger.batch_size)
+    while True:
+        window = list(itertools.islice(lines, window_size))
+        if not window:
+            return
+        order = list(range(len(window)))
+        if SORT_WINDOW > 0:
+            order.sort(key=lambda i: window[i][1])
+        for start in range(0, len(order), tagger.batch_size):
+            positions = order[start : start + tagger.batch_size]
+            sents, lengths = zip(*(window[i] for i in positions))
+            last = start + tagger.batch_size >= len(order)
+            yield sents, lengths, pack(sents), positions, last
+
+
+def pack(sents: Any) -> list[Any]:
+    """
+    Encode the sentences into tensors for each model, the first half of tagger.tag.
+    """
+    batch_sents = sents
+    if tagger.lower:
+        batch_sents = [[w.lower() for w in sent] for sent in sents]
+    # add dummy input tasks (None)
+    batch = list(zip(batch_sents, itertools.repeat(None)))
+    return [
+        pack_batch(model.label_encoder, batch, tagger.device)[0]
+        for model, _ in tagger.models
+    ]
+
+
+def tag_packed(
+    sents: Any, lengths: Any, inputs: list[Any], **kwargs: Any
+) -> tuple[list[Any], list[str]]:
+    """
+    Run the models on the packed inputs, the second half of tagger.tag.
+    Returns the tagged sentences and the names of the tasks.
+    """
+    tokens = [token for sent in sents for token in sent]
+    output = {}
+    for (model, tasks), inp in zip(tagger.models, inputs):
+        preds = model.predict(inp, *tasks, **kwargs)
+        for task in preds:
+            settings = model.label_encoder.tasks[task]
+            # flatten all sentences (since some tasks return flattened output)
+            if settings.level != "char":
+                preds[task] = [hyp for sent in preds[task] for hyp in sent]
+            # postprocess if needed
+            if settings.preprocessor_fn is not None:
+                preds[task] = [
+                    settings.preprocessor_fn.inverse_transform(hyp, tok)
+                    for tok, hyp in zip(tokens, preds[task])
+                ]
+            output[task] = preds[task]
+
+    tasks = sorted(output)
+    # [(task1, task2, ...), (task1, task2, ...), ...]
+    tags = list(zip(*(output[task] for task in tasks)))
+    # segment sentences
+    tagged = []
+    start = 0
+    for length in lengths:
+        end = start + length
+        tagged.append(list(zip(tokens[start:end], tags[start:end])))
+        start = end
+    return tagged, tasks
+
+
+def prefetch(items: Iterator, size: int) -> Iterator:
+    """
+    Consume the items iterator in a producer thread that stays at most size items ahead.
+    Exceptions of the producer are raised in the consumer.
+    """
+    if size == 0:
+        yield from items
+        return
+
+    done = object()
+    q: queue.Queue = queue.Queue(maxsize=size)
+    # Set when the consumer stops early, e.g. on a timeout, so the producer does not block forever.
+    stop = threading.Event()
+
+    def put(item: Any) -> None:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def produce() -> None:
+        try:
+            for item in items:
+                put(item)
+                if stop.is_set():
+                    return
+            put(done)
+        except Exception as e:
+            put(e)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = q.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def write_tagged(in_file: str, f: TextIO, prefetch_batches: int) -> None:
+    """
+    Tag the file and write the result to f, the same as tagger.tag_file(keep_boundaries=False).
+    Tagged sentences are collected per window and written in their original order.
+    """
+    header = False
+    window: dict[int, Any] = {}
+    for sents, lengths, inputs, positions, last in prefetch(
+        get_batches(in_file), prefetch_batches
+    ):
+        tagged, tasks = tag_packed(
+            sents, lengths, inputs, use_beam=False, beam_width=10
+        )
+        window.update(zip(positions, tagged))
+        if not last:
+            continue
+        for i in range(len(window)):
+            if not header:
+                f.write("\t".join(["token"] + tasks) + "\n")
+                header = True
+            for token, tags in window[i]:
+                f.write("\t".join([token] + list(tags)) + "\n")
+        window = {}
+
+
 def process(in_file: str, out_file: str) -> None:
     """
-    Process the file with the global tagger instance.
-    Pie outputs to the same directory as the input file.
-    We process the file in a temporary directory so we don't polute /input.
+    Process the file with the global tagger instance, while the next batches are prepared in the producer thread.
+    The result is written in a temporary directory and only moved to out_file once it is complete,
+    so a failed or killed task does not leave a partial output behind.
     """
     with tempfile.TemporaryDirectory() as temp_dir:
-        # input
-        temp_in_file = os.path.join(temp_dir, "file.txt")
-        shutil.copy(in_file, temp_in_file)
-        # tag
-        tagger.tag_file(
-            temp_in_file, use_beam=False, beam_width=10, keep_boundaries=False
-        )
-        # output
-        temp_result_file = os.path.join(temp_dir, "file-pie.txt")
-        shutil.move(temp_result_file, out_file)
+        temp_out_file = os.path.join(temp_dir, "file.tsv")
+        with open(temp_out_file, "w") as f:
+            write_tagged(in_file, f, PREFETCH_BATCHES)
+        shutil.move(temp_out_file, out_file)
+
+
+def process_text(text: str) -> str:
+    """
+    Process a short text with the global tagger instance, for /tag.
+    Pie only reads its input from a file, but the output stays in memory.
+    A short text fits in a few batches, so there is nothing to gain from the producer thread.
+    """
+    with tempfile.NamedTemporaryFile("w", suffix=".txt") as f_in:
+        f_in.write(text)
+        f_in.flush()
+        out = io.StringIO()
+        write_tagged(f_in.name, out, 0)
+        return out.getvalue()